@@ -25,6 +25,7 @@ def get_version(rel_path):
 
 
 INSTALL_REQUIRED = [
+    "numpy",
     "pandas >= 1.0.0",
     "tensorboard >= 1.15, !=2.1.0"
 ]
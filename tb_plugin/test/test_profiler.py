@@ -1,21 +1,111 @@
 import os
 import gzip
 import json
+import tempfile
 import unittest
+from unittest import mock
 
+import torch_tb_profiler.io as io
+from torch_tb_profiler.io.file import LocalFileSystem, _REGISTERED_FILESYSTEMS
+from torch_tb_profiler import utils
 from torch_tb_profiler.profiler.data import DistributedRunProfileData, RunProfileData
+from torch_tb_profiler.profiler import multiprocessing as loader_mp
+from torch_tb_profiler.profiler import loader as loader_module
 from torch_tb_profiler.profiler.loader import RunLoader
 from torch_tb_profiler.profiler.overall_parser import ProfileRole
-from torch_tb_profiler.run import RunProfile
+from torch_tb_profiler.run import Run, RunProfile
 
 SCHEMA_VERSION = 1
 WORKER_NAME = "worker0"
 
 
-def parse_json_trace(json_content, worker_name = WORKER_NAME) -> RunProfileData:
+def parse_json_trace(json_content, worker_name = WORKER_NAME, span = 0) -> RunProfileData:
     trace_json = json.loads(json_content)
     trace_json = {"schemaVersion": 1, "traceEvents": trace_json}
-    return RunProfileData.from_json(worker_name, 0, trace_json)
+    return RunProfileData.from_json(worker_name, span, trace_json)
+
+
+# Two workers running one nccl broadcast and one nccl all_reduce.
+NCCL_TRACE_WORKER0 = """
+[
+{
+  "ph": "X", "cat": "cpu_op",
+  "name": "nccl:broadcast", "pid": 23803, "tid": "23803",
+  "ts": 0, "dur": 75,
+  "args": {"External id": 146, "Input Dims": [[53120]], "Input type": ["float"]}
+},
+{
+  "ph": "X", "cat": "Kernel",
+  "name": "ncclKernel_Broadcast_RING_LL_Sum_int8_t(ncclWorkElem)", "pid": 0, "tid": "stream 16",
+  "ts": 16, "dur": 16,
+  "args": {"device": 0, "correlation": 28506, "external id": 146}
+},
+{
+  "ph": "X", "cat": "cpu_op",
+  "name": "aten::add_", "pid": 23803, "tid": "23803",
+  "ts": 100, "dur": 20,
+  "args": {"External id": 24504, "Input Dims": [[1000], [1000], []], "Input type": ["float", "float", "Int"]}
+},
+{
+  "ph": "X", "cat": "Kernel",
+  "name": "void at::native::vectorized_elementwise_kernel", "pid": 0, "tid": "stream 7",
+  "ts": 130, "dur": 161,
+  "args": {"device": 0, "correlation": 99765, "external id": 24504}
+},
+{
+  "ph": "X", "cat": "cpu_op",
+  "name": "nccl:all_reduce", "pid": 23803, "tid": "25166",
+  "ts": 160, "dur": 75,
+  "args": {"External id": 2513, "Input Dims": [[2049000]], "Input type": ["float"]}
+},
+{
+  "ph": "X", "cat": "Kernel",
+  "name": "ncclKernel_AllReduce_RING_LL_Sum_float(ncclWorkElem)", "pid": 0, "tid": "stream 16",
+  "ts": 162, "dur": 1556,
+  "args": {"device": 0, "correlation": 33218, "external id": 2513}
+}
+]
+"""
+NCCL_TRACE_WORKER1 = """
+[
+{
+  "ph": "X", "cat": "cpu_op",
+  "name": "nccl:broadcast", "pid": 23803, "tid": "23803",
+  "ts": 0, "dur": 20,
+  "args": {"External id": 146, "Input Dims": [[53120]], "Input type": ["float"]}
+},
+{
+  "ph": "X", "cat": "Kernel",
+  "name": "ncclKernel_Broadcast_RING_LL_Sum_int8_t(ncclWorkElem)", "pid": 0, "tid": "stream 16",
+  "ts": 8, "dur": 31,
+  "args": {"device": 0, "correlation": 28506, "external id": 146}
+},
+{
+  "ph": "X", "cat": "cpu_op",
+  "name": "aten::add_", "pid": 23803, "tid": "23803",
+  "ts": 25, "dur": 20,
+  "args": {"External id": 24504, "Input Dims": [[1000], [1000], []], "Input type": ["float", "float", "Int"]}
+},
+{
+  "ph": "X", "cat": "Kernel",
+  "name": "void at::native::vectorized_elementwise_kernel", "pid": 0, "tid": "stream 7",
+  "ts": 30, "dur": 161,
+  "args": {"device": 0, "correlation": 99765, "external id": 24504}
+},
+{
+  "ph": "X", "cat": "cpu_op",
+  "name": "nccl:all_reduce", "pid": 23803, "tid": "25166",
+  "ts": 160, "dur": 75,
+  "args": {"External id": 2513, "Input Dims": [[2049000]], "Input type": ["float"]}
+},
+{
+  "ph": "X", "cat": "Kernel",
+  "name": "ncclKernel_AllReduce_RING_LL_Sum_float(ncclWorkElem)", "pid": 0, "tid": "stream 16",
+  "ts": 562, "dur": 1058,
+  "args": {"device": 0, "correlation": 33218, "external id": 2513}
+}
+]
+"""
 
 
 '''
@@ -2017,94 +2107,14 @@ class TestProfiler(unittest.TestCase):
             self.assertEqual(agg_kernel.op_tc_eligible, expected_agg_kernel["op_tc_eligible"])
 
     def test_distributed_nccl(self):
-        json_content0 = """
-        [
-        {
-          "ph": "X", "cat": "cpu_op",
-          "name": "nccl:broadcast", "pid": 23803, "tid": "23803",
-          "ts": 0, "dur": 75,
-          "args": {"External id": 146, "Input Dims": [[53120]], "Input type": ["float"]}
-        },
-        {
-          "ph": "X", "cat": "Kernel",
-          "name": "ncclKernel_Broadcast_RING_LL_Sum_int8_t(ncclWorkElem)", "pid": 0, "tid": "stream 16",
-          "ts": 16, "dur": 16,
-          "args": {"device": 0, "correlation": 28506, "external id": 146}
-        },
-        {
-          "ph": "X", "cat": "cpu_op",
-          "name": "aten::add_", "pid": 23803, "tid": "23803",
-          "ts": 100, "dur": 20,
-          "args": {"External id": 24504, "Input Dims": [[1000], [1000], []], "Input type": ["float", "float", "Int"]}
-        },
-        {
-          "ph": "X", "cat": "Kernel",
-          "name": "void at::native::vectorized_elementwise_kernel", "pid": 0, "tid": "stream 7",
-          "ts": 130, "dur": 161,
-          "args": {"device": 0, "correlation": 99765, "external id": 24504}
-        },
-        {
-          "ph": "X", "cat": "cpu_op",
-          "name": "nccl:all_reduce", "pid": 23803, "tid": "25166",
-          "ts": 160, "dur": 75,
-          "args": {"External id": 2513, "Input Dims": [[2049000]], "Input type": ["float"]}
-        },
-        {
-          "ph": "X", "cat": "Kernel",
-          "name": "ncclKernel_AllReduce_RING_LL_Sum_float(ncclWorkElem)", "pid": 0, "tid": "stream 16",
-          "ts": 162, "dur": 1556,
-          "args": {"device": 0, "correlation": 33218, "external id": 2513}
-        }
-        ]
-        """
-        json_content1 = """
-        [
-        {
-          "ph": "X", "cat": "cpu_op",
-          "name": "nccl:broadcast", "pid": 23803, "tid": "23803",
-          "ts": 0, "dur": 20,
-          "args": {"External id": 146, "Input Dims": [[53120]], "Input type": ["float"]}
-        },
-        {
-          "ph": "X", "cat": "Kernel",
-          "name": "ncclKernel_Broadcast_RING_LL_Sum_int8_t(ncclWorkElem)", "pid": 0, "tid": "stream 16",
-          "ts": 8, "dur": 31,
-          "args": {"device": 0, "correlation": 28506, "external id": 146}
-        },
-        {
-          "ph": "X", "cat": "cpu_op",
-          "name": "aten::add_", "pid": 23803, "tid": "23803",
-          "ts": 25, "dur": 20,
-          "args": {"External id": 24504, "Input Dims": [[1000], [1000], []], "Input type": ["float", "float", "Int"]}
-        },
-        {
-          "ph": "X", "cat": "Kernel",
-          "name": "void at::native::vectorized_elementwise_kernel", "pid": 0, "tid": "stream 7",
-          "ts": 30, "dur": 161,
-          "args": {"device": 0, "correlation": 99765, "external id": 24504}
-        },
-        {
-          "ph": "X", "cat": "cpu_op",
-          "name": "nccl:all_reduce", "pid": 23803, "tid": "25166",
-          "ts": 160, "dur": 75,
-          "args": {"External id": 2513, "Input Dims": [[2049000]], "Input type": ["float"]}
-        },
-        {
-          "ph": "X", "cat": "Kernel",
-          "name": "ncclKernel_AllReduce_RING_LL_Sum_float(ncclWorkElem)", "pid": 0, "tid": "stream 16",
-          "ts": 562, "dur": 1058,
-          "args": {"device": 0, "correlation": 33218, "external id": 2513}
-        }
-        ]
-        """
 
-        profile0 = parse_json_trace(json_content0, "worker0")
+        profile0 = parse_json_trace(NCCL_TRACE_WORKER0, "worker0")
         dist_data0 = DistributedRunProfileData(profile0)
         self.assertTrue(profile0.has_communication)
         self.assertEqual(len(profile0.comm_node_list), 2)
         self.assertEqual(profile0.steps_costs[0].costs, [105, 0, 0, 16, 0, 0, 79, 35, 235])
 
-        profile1 = parse_json_trace(json_content1, "worker1")
+        profile1 = parse_json_trace(NCCL_TRACE_WORKER1, "worker1")
         dist_data1 = DistributedRunProfileData(profile1)
         self.assertTrue(profile1.has_communication)
         self.assertEqual(len(profile1.comm_node_list), 2)
@@ -2121,6 +2131,69 @@ class TestProfiler(unittest.TestCase):
         self.assertEqual(dist_profile.comm_ops['data']['worker1']['rows'],
             [['nccl:broadcast', 1, 212480, 212480, 31, 31, 16, 16], ['nccl:all_reduce', 1, 8196000, 8196000, 1058, 1058, 1058, 1058]])
 
+    def test_distributed_nccl_kernel_count_mismatch(self):
+        profile0 = parse_json_trace(NCCL_TRACE_WORKER0, "worker0")
+        profile1 = parse_json_trace(NCCL_TRACE_WORKER1, "worker1")
+        # worker1 launches one more kernel for the broadcast than worker0.
+        profile1.comm_node_list[0].kernel_ranges.append((40, 50))
+
+        loader = RunLoader("test_nccl_mismatch", "", None)
+        dist_profile = loader._process_distributed_profiles(
+            [DistributedRunProfileData(profile0), DistributedRunProfileData(profile1)], 0)
+        self.assertIsNone(dist_profile)
+
+    def test_distributed_nccl_node_without_kernels(self):
+        profile0 = parse_json_trace(NCCL_TRACE_WORKER0, "worker0")
+        profile1 = parse_json_trace(NCCL_TRACE_WORKER1, "worker1")
+        # The broadcast launches no kernel on either worker.
+        profile0.comm_node_list[0].kernel_ranges.clear()
+        profile1.comm_node_list[0].kernel_ranges.clear()
+
+        loader = RunLoader("test_nccl_no_kernels", "", None)
+        dist_profile = loader._process_distributed_profiles(
+            [DistributedRunProfileData(profile0), DistributedRunProfileData(profile1)], 0)
+        self.assertIsNotNone(dist_profile)
+        self.assertEqual(profile0.comm_node_list[0].real_time_ranges, [])
+        self.assertEqual(profile1.comm_node_list[0].real_time_ranges, [])
+        # The shortest all_reduce kernel (1058us on worker1) is the real communication time of both workers.
+        self.assertEqual(profile0.comm_node_list[1].real_time_ranges, [(660, 1718)])
+        self.assertEqual(profile1.comm_node_list[1].real_time_ranges, [(562, 1620)])
+
+    def test_distributed_nccl_float_timestamps(self):
+        profile0 = parse_json_trace(NCCL_TRACE_WORKER0, "worker0")
+        profile1 = parse_json_trace(NCCL_TRACE_WORKER1, "worker1")
+        # Only the all_reduce kernel of worker1 has fractional timestamps.
+        profile1.comm_node_list[1].kernel_ranges[0] = (562.5, 1620.5)
+
+        loader = RunLoader("test_nccl_float_ts", "", None)
+        dist_profile = loader._process_distributed_profiles(
+            [DistributedRunProfileData(profile0), DistributedRunProfileData(profile1)], 0)
+        self.assertIsNotNone(dist_profile)
+        real_time_ranges = [[node.real_time_ranges for node in profile.comm_node_list] for profile in (profile0, profile1)]
+        self.assertEqual(real_time_ranges, [[[(16, 32)], [(660.0, 1718)]], [[(23, 39)], [(562.5, 1620.5)]]])
+        # The broadcast kernels only have int timestamps, so their real time ranges stay ints.
+        self.assertEqual([[[type(t) for r in node_ranges for t in r] for node_ranges in worker_ranges]
+                          for worker_ranges in real_time_ranges],
+                         [[[int, int], [float, int]], [[int, int], [float, float]]])
+
+    def test_distributed_nccl_multiple_spans(self):
+        distributed_run = Run("test_nccl_spans", "")
+        for span in (1, 2):
+            for worker, json_content in (("worker0", NCCL_TRACE_WORKER0), ("worker1", NCCL_TRACE_WORKER1)):
+                profile = parse_json_trace(json_content, worker, span)
+                distributed_run.add_profile(DistributedRunProfileData(profile))
+
+        loader = RunLoader("test_nccl_spans", "", None)
+        dist_profiles = loader._process_spans(distributed_run)
+        self.assertEqual([p.span for p in dist_profiles], ["1", "2"])
+        for dist_profile in dist_profiles:
+            self.assertEqual(dist_profile.steps_to_wait['data']['0']['worker0'], [1074, 498])
+            self.assertEqual(dist_profile.steps_to_wait['data']['0']['worker1'], [1074, 15])
+            self.assertEqual(dist_profile.comm_ops['data']['worker0']['rows'],
+                [['nccl:broadcast', 1, 212480, 212480, 16, 16, 16, 16], ['nccl:all_reduce', 1, 8196000, 8196000, 1556, 1556, 1058, 1058]])
+            self.assertEqual(dist_profile.comm_ops['data']['worker1']['rows'],
+                [['nccl:broadcast', 1, 212480, 212480, 31, 31, 16, 16], ['nccl:all_reduce', 1, 8196000, 8196000, 1058, 1058, 1058, 1058]])
+
     def test_distributed_gloo_gpu(self):
         json_content0 = """
         [
@@ -2356,6 +2429,120 @@ class TestProfiler(unittest.TestCase):
             [['gloo:broadcast', 3, 637440, 212480, 44, 15, 44, 15], ['gloo:all_reduce', 2, 16392000, 8196000, 54, 27, 34, 17]])
 
 
+class CrashingFileSystem(LocalFileSystem):
+    """Local files behind the crash:// prefix. Downloading a worker1 trace kills the process."""
+    PREFIX = "crash://"
+
+    def walk(self, top, topdown=True, onerror=None):
+        for root, dirs, files in super().walk(top[len(self.PREFIX):], topdown, onerror):
+            yield self.PREFIX + root, dirs, files
+
+    def download_file(self, filename):
+        local_file = filename[len(self.PREFIX):]
+        if os.path.basename(local_file).startswith("worker1"):
+            os._exit(1)
+        return local_file
+
+
+class DyingFileSystem(LocalFileSystem):
+    """A file system that kills the worker process while the cache of the loader is unpickled in it,
+    before the worker can start any task."""
+    def __reduce__(self):
+        return os._exit, (1,)
+
+
+class TestRunLoader(unittest.TestCase):
+    def test_load_with_terminated_worker(self):
+        thread_env = {name: os.environ.get(name) for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")}
+        with tempfile.TemporaryDirectory() as run_dir:
+            for worker, json_content in (("worker0", NCCL_TRACE_WORKER0), ("worker1", NCCL_TRACE_WORKER1)):
+                with open(os.path.join(run_dir, worker + ".pt.trace.json"), "w") as f:
+                    json.dump({"schemaVersion": 1, "traceEvents": json.loads(json_content)}, f)
+
+            io.register_filesystem("crash", CrashingFileSystem())
+            try:
+                with io.Cache() as cache:
+                    run = RunLoader("test_crash", CrashingFileSystem.PREFIX + run_dir, cache).load()
+            finally:
+                del _REGISTERED_FILESYSTEMS["crash"]
+
+        self.assertIn("worker0", run.workers)
+        self.assertNotIn("worker1", run.workers)
+        # The single threaded settings of the workers must not leak into the plugin process.
+        self.assertEqual({name: os.environ.get(name) for name in thread_env}, thread_env)
+
+    def test_load_with_workers_dying_at_start(self):
+        with tempfile.TemporaryDirectory() as run_dir:
+            with open(os.path.join(run_dir, "worker0.pt.trace.json"), "w") as f:
+                json.dump({"schemaVersion": 1, "traceEvents": json.loads(NCCL_TRACE_WORKER0)}, f)
+
+            with io.Cache() as cache:
+                io.register_filesystem("dying", DyingFileSystem())
+                try:
+                    with mock.patch.object(loader_module, "_MAX_STALLED_POLLS", 3):
+                        run = RunLoader("test_dying", run_dir, cache).load()
+                finally:
+                    del _REGISTERED_FILESYSTEMS["dying"]
+
+        self.assertEqual(run.profiles, {})
+
+    def test_list_files_top_level_only(self):
+        with tempfile.TemporaryDirectory() as run_dir:
+            for path in ("worker0.pt.trace.json", "notes.txt", os.path.join("sub", "worker1.pt.trace.json")):
+                os.makedirs(os.path.dirname(os.path.join(run_dir, path)), exist_ok=True)
+                with open(os.path.join(run_dir, path), "w") as f:
+                    f.write("[]")
+            os.makedirs(os.path.join(run_dir, "worker2.pt.trace.json"))
+
+            files = RunLoader("test_list", run_dir, None)._list_files()
+            files_with_slash = RunLoader("test_list", run_dir + "/", None)._list_files()
+
+        self.assertEqual(sorted(files), ["notes.txt", "worker0.pt.trace.json"])
+        self.assertEqual(sorted(files_with_slash), ["notes.txt", "worker0.pt.trace.json"])
+
+    def test_list_files_missing_run_dir(self):
+        with tempfile.TemporaryDirectory() as run_dir:
+            loader = RunLoader("test_missing", os.path.join(run_dir, "missing"), None)
+            with self.assertRaises(FileNotFoundError):
+                loader._list_files()
+            with self.assertRaises(FileNotFoundError):
+                loader.load()
+
+    def test_load_without_traces(self):
+        thread_env = {name: os.environ.get(name) for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")}
+        with tempfile.TemporaryDirectory() as run_dir:
+            with open(os.path.join(run_dir, "notes.txt"), "w") as f:
+                f.write("no traces")
+            with mock.patch.object(loader_mp, "Pool", side_effect=AssertionError("no pool expected")):
+                run = RunLoader("test_empty", run_dir, None).load()
+
+        self.assertEqual(run.profiles, {})
+        self.assertEqual({name: os.environ.get(name) for name in thread_env}, thread_env)
+
+    def test_load_trace_files_only(self):
+        trace_json = json.dumps({"schemaVersion": 1, "traceEvents": json.loads(NCCL_TRACE_WORKER0)})
+        with tempfile.TemporaryDirectory() as run_dir:
+            for path in ("worker0.pt.trace.json", "worker1.pt.trace.json.bak", "worker2.json"):
+                with open(os.path.join(run_dir, path), "w") as f:
+                    f.write(trace_json)
+            with gzip.open(os.path.join(run_dir, "worker3.1623143089861.pt.trace.json.gz"), "wt") as f:
+                f.write(trace_json)
+
+            with io.Cache() as cache:
+                run = RunLoader("test_suffix", run_dir, cache).load()
+
+        # The "All" profiles are the distributed view of the two parsed traces.
+        self.assertEqual(sorted(run.profiles.keys()),
+                         [("All", "1"), ("All", "default"), ("worker0", "default"), ("worker3", "1")])
+
+    def test_is_chrome_trace_file(self):
+        for path in ("worker0.pt.trace.json", "worker0.pt.trace.json.gz", "worker0.1623143089861.pt.trace.json",
+                     "node.1.pt.trace.json.gz", ".pt.trace.json"):
+            self.assertTrue(utils.is_chrome_trace_file(path), path)
+        for path in ("worker0.pt.trace.json.bak", "worker0.json", "worker0.pt.trace.jsongz", "notes.txt"):
+            self.assertFalse(utils.is_chrome_trace_file(path), path)
+
+
 class TestMemoryCurve(unittest.TestCase):
     
     def __init__(self, *args, **kwargs):
@@ -10,6 +10,8 @@ WORKER_PATTERN = re.compile(r"""^(.*?) # worker name
         (\.\d+)? # optional timestamp like 1619499959628 used as span name
         \.pt\.trace\.json # the ending suffix
         (?:\.gz)?$""", re.X)  # optional .gz extension
+# Every name matched by WORKER_PATTERN ends with one of these, checked before running the regex.
+TRACE_FILE_SUFFIXES = (".pt.trace.json", ".pt.trace.json.gz")
 
 NODE_PROCESS_PATTERN = re.compile(r"""^(.*)_(\d+)""")
 MONITOR_RUN_REFRESH_INTERNAL_IN_SECONDS = 10
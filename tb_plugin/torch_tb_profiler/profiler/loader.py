@@ -2,34 +2,48 @@
 # -------------------------------------------------------------------------
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # --------------------------------------------------------------------------
-import bisect
+import contextlib
 import os
-import sys
+import queue
+import threading
 from collections import defaultdict
 
+import numpy as np
+
 from .. import consts, io, utils
 from ..run import Run
-from .multiprocessing import Process, Queue
+from . import multiprocessing as mp
 from .data import DistributedRunProfileData, RunProfileData
 from .run_generator import DistributedRunGenerator, RunGenerator
 
 logger = utils.get_logger()
 
+# The cache of the run loader that started the worker process. It holds a lock that can only be
+# shared with the worker process when it is spawned, so it is handed over by _init_worker.
+_caches = None
+# The queue on which a worker reports (task index, pid) before it starts parsing a trace.
+_started = None
+# Serializes the temporary changes of the thread count environment variables, see _single_threaded_workers.
+_thread_env_lock = threading.Lock()
+# The number of one second polls load() waits while no live worker is parsing any of the pending traces,
+# e.g. because the pool keeps replacing workers that die before they can start a task.
+_MAX_STALLED_POLLS = 60
+
 
 class RunLoader(object):
     def __init__(self, name, run_dir, caches):
         self.run_name = name
         self.run_dir = run_dir
         self.caches = caches
-        self.queue = Queue()
 
     def load(self):
         workers = []
         spans_by_workers = defaultdict(list)
-        for path in io.listdir(self.run_dir):
-            if io.isdir(io.join(self.run_dir, path)):
+        match_worker = consts.WORKER_PATTERN.match
+        for path in self._list_files():
+            if not path.endswith(consts.TRACE_FILE_SUFFIXES):
                 continue
-            match = consts.WORKER_PATTERN.match(path)
+            match = match_worker(path)
             if not match:
                 continue
 
@@ -38,69 +52,117 @@ class RunLoader(object):
             if span is not None:
                 # remove the starting dot (.)
                 span = span[1:]
-                bisect.insort(spans_by_workers[worker], span)
+                spans_by_workers[worker].append(span)
 
             workers.append((worker, span, path))
 
-        span_index_map = {}
-        for worker, span_array in spans_by_workers.items():
-            for i, span in enumerate(span_array, 1):
-                span_index_map[(worker, span)] = i
+        for spans in spans_by_workers.values():
+            spans.sort()
 
-        for worker, span, path in workers:
-            # convert the span timestamp to the index.
-            span_index = None if span is None else span_index_map[(worker, span)]
-            p = Process(target=self._process_data, args=(worker, span_index, path))
-            p.start()
-        logger.info("started all processing")
+        span_index_map = {(worker, span): i
+                          for worker, span_array in spans_by_workers.items()
+                          for i, span in enumerate(span_array, 1)}
 
-        distributed_run = Run(self.run_name, self.run_dir)
         run = Run(self.run_name, self.run_dir)
-        num_items = len(workers)
-        while num_items > 0:
-            item = self.queue.get()
-            num_items -= 1
-            r, d = item
-            if r or d:
-                logger.debug("Loaded profile via mp.Queue")
-            if r is not None:
-                run.add_profile(r)
-            if d is not None:
-                distributed_run.add_profile(d)
+        if not workers:
+            # Nothing to parse, do not start a pool for it.
+            return run
+
+        distributed_run = Run(self.run_name, self.run_dir)
+        # Bound the number of parsing processes instead of starting one process per trace file.
+        processes = min(len(workers), os.cpu_count() or 1)
+        results = queue.Queue()
+        started = mp.SimpleQueue()
+        with _single_threaded_workers():
+            pool = mp.Pool(processes=processes, initializer=_init_worker, initargs=(self.caches, started))
+        with pool:
+            for index, (worker, span, path) in enumerate(workers):
+                # convert the span timestamp to the index.
+                span_index = None if span is None else span_index_map[(worker, span)]
+                pool.apply_async(_process_data, (index, self.run_name, self.run_dir, worker, span_index, path),
+                                 callback=results.put,
+                                 error_callback=lambda ex, index=index: self._on_process_error(index, workers, ex, results))
+            logger.info("started all processing")
+
+            pending = set(range(len(workers)))
+            running = {}  # pid of a worker -> index of the last trace it started
+            stalled_polls = 0
+            while pending:
+                try:
+                    index, r, d = results.get(timeout=1.0)
+                except queue.Empty:
+                    index = None
+                # Take the start reports on every pass, so that the pipe behind started cannot fill up
+                # and block the workers.
+                while not started.empty():
+                    started_index, pid = started.get()
+                    running[pid] = started_index
+                if index is None:
+                    self._discard_lost_tasks(running, pending, workers)
+                    if any(i in pending for i in running.values()):
+                        stalled_polls = 0
+                    else:
+                        stalled_polls += 1
+                        if stalled_polls >= _MAX_STALLED_POLLS:
+                            self._discard_stalled_tasks(pending, workers)
+                    continue
+                stalled_polls = 0
+                if index not in pending:
+                    continue
+                pending.discard(index)
+                if r or d:
+                    logger.debug("Loaded profile via process pool")
+                if r is not None:
+                    run.add_profile(r)
+                if d is not None:
+                    distributed_run.add_profile(d)
 
         distributed_profiles = self._process_spans(distributed_run)
         for d in distributed_profiles:
             if d is not None:
                 run.add_profile(d)
 
-        # for no daemon process, no need to join them since it will automatically join
         return run
 
-    def _process_data(self, worker, span, path):
-        import absl.logging
-        absl.logging.use_absl_handler()
+    def _on_process_error(self, index, workers, ex, results):
+        # Called by the pool when a task fails outside of _process_data, e.g. its result cannot be pickled.
+        logger.warning("Failed to parse profile data for Run %s on %s. Exception=%s",
+                       self.run_name, workers[index][2], ex)
+        results.put((index, None, None))
 
-        try:
-            logger.debug("Parse trace, run_dir=%s, worker=%s", self.run_dir, path)
-            local_file = self.caches.get_remote_cache(io.join(self.run_dir, path))
-            data, trace_path = RunProfileData.parse(worker, span, local_file)
-            if trace_path != local_file:
-                self.caches.add_file(local_file, trace_path)
-
-            generator = RunGenerator(worker, span, data)
-            profile = generator.generate_run_profile()
-            dist_data = DistributedRunProfileData(data)
-
-            logger.debug("Sending back profile via mp.Queue")
-            self.queue.put((profile, dist_data))
-        except KeyboardInterrupt:
-            logger.warning("tb_plugin receive keyboard interrupt signal, process %d will exit" % (os.getpid()))
-            sys.exit(1)
-        except Exception as ex:
-            logger.warning("Failed to parse profile data for Run %s on %s. Exception=%s",
-                               self.run_name, worker, ex, exc_info=True)
-            self.queue.put((None, None))
-        logger.debug("finishing process data")
+    def _discard_lost_tasks(self, running, pending, workers):
+        """The pool silently replaces a worker that was terminated abruptly (e.g. killed for running
+        out of memory) and never reports its task, so find the tasks whose worker is gone.
+        """
+        alive = {p.pid for p in mp.active_children()}
+        for pid, index in list(running.items()):
+            if pid not in alive:
+                del running[pid]
+                if index in pending:
+                    logger.error("Failed to parse profile data for Run %s on %s. The worker process %d was terminated",
+                                 self.run_name, workers[index][2], pid)
+                    pending.discard(index)
+
+    def _discard_stalled_tasks(self, pending, workers):
+        for index in sorted(pending):
+            logger.error("Failed to parse profile data for Run %s on %s. No worker process could start parsing it",
+                         self.run_name, workers[index][2])
+        pending.clear()
+
+    def _list_files(self):
+        """List the files directly under the run directory.
+        The first level of io.walk comes from os.scandir for local paths and from a single listing for
+        blob storage, instead of one io.isdir call per directory entry.
+        Raises an error like io.listdir does when the run directory cannot be listed.
+        """
+        def raise_error(ex):
+            raise ex
+
+        run_dir = self.run_dir.rstrip('/')
+        for root, _, files in io.walk(self.run_dir, onerror=raise_error):
+            if root.rstrip('/') == run_dir:
+                return files
+        raise FileNotFoundError("Run directory %s is not found" % self.run_dir)
 
     def _process_spans(self, distributed_run):
         spans = distributed_run.get_spans()
@@ -116,43 +178,40 @@ class RunLoader(object):
             return span_profiles
 
     def _process_distributed_profiles(self, profiles, span):
-        has_communication = True
         comm_node_lists = []
         for data in profiles:
-            logger.debug("Processing profile data")
-            # Set has_communication to False and disable distributed view if any one worker has no communication
-            if data.has_communication and data.comm_node_list:
-                comm_node_lists.append(data.comm_node_list)
-                if len(comm_node_lists[-1]) != len(comm_node_lists[0]):
-                    logger.error("Number of communication operation nodes don't match between workers in run: %s" % self.run_name)
-                    has_communication = False
-            else:
-                has_communication = False
-            logger.debug("Processing profile data finish")
-
-        if not has_communication:
-            logger.debug("There is no communication profile in this run.")
-            return None
+            # Disable distributed view as soon as any one worker has no communication
+            if not (data.has_communication and data.comm_node_list):
+                logger.debug("There is no communication profile in this run.")
+                return None
+            if comm_node_lists and len(data.comm_node_list) != len(comm_node_lists[0]):
+                logger.error("Number of communication operation nodes don't match between workers in run: %s" % self.run_name)
+                return None
+            comm_node_lists.append(data.comm_node_list)
 
         worker_num = len(comm_node_lists)
-        for i, node in enumerate(comm_node_lists[0]):
-            kernel_range_size = len(node.kernel_ranges)
-            # loop for all communication kernel ranges in order
-            for j in range(kernel_range_size):
-                min_range = sys.maxsize
-                # For each kernel_range, find the minist between workers as the real communication time
-                for k in range(worker_num):
-                    kernel_ranges = comm_node_lists[k][i].kernel_ranges
-                    if len(kernel_ranges) != kernel_range_size:
-                        logger.error("Number of communication kernels don't match between workers in run: %s" % self.run_name)
-                        has_communication = False
-                        return None
-                    if kernel_ranges:
-                        if kernel_ranges[j][1] - kernel_ranges[j][0] < min_range:
-                            min_range = kernel_ranges[j][1] - kernel_ranges[j][0]
-                for k in range(worker_num):
-                    kernel_range = comm_node_lists[k][i].kernel_ranges[j]
-                    comm_node_lists[k][i].real_time_ranges.append((kernel_range[1] - min_range, kernel_range[1]))
+        kernel_counts = [[len(node.kernel_ranges) for node in comm_node_list] for comm_node_list in comm_node_lists]
+        if any(counts != kernel_counts[0] for counts in kernel_counts[1:]):
+            logger.error("Number of communication kernels don't match between workers in run: %s" % self.run_name)
+            return None
+
+        # kernel_ranges[k][n] is the n-th communication kernel range of worker k, in node order.
+        flat_ranges = [[r for node in comm_node_list for r in node.kernel_ranges] for comm_node_list in comm_node_lists]
+        kernel_ranges = np.array(flat_ranges)
+        if kernel_ranges.dtype.kind == 'f' and not all(isinstance(t, float) for rs in flat_ranges for r in rs for t in r):
+            # The timestamps mix ints and floats. Compute on the Python values instead of promoting all of them
+            # to float, so that each real time range keeps the type it would get from plain arithmetic.
+            kernel_ranges = np.array(flat_ranges, dtype=object)
+        kernel_ranges = kernel_ranges.reshape(worker_num, -1, 2)
+        # For each kernel range, find the minist between workers as the real communication time
+        min_ranges = (kernel_ranges[:, :, 1] - kernel_ranges[:, :, 0]).min(axis=0)
+        ends = kernel_ranges[:, :, 1]
+        real_time_ranges = np.stack((ends - min_ranges, ends), axis=-1).tolist()
+        for comm_node_list, worker_real_time_ranges in zip(comm_node_lists, real_time_ranges):
+            index = 0
+            for node, count in zip(comm_node_list, kernel_counts[0]):
+                node.real_time_ranges.extend(map(tuple, worker_real_time_ranges[index:index + count]))
+                index += count
 
         for data in profiles:
             data.communication_parse()
@@ -160,3 +219,57 @@ class RunLoader(object):
         generator = DistributedRunGenerator(profiles, span)
         profile = generator.generate_run_profile()
         return profile
+
+
+@contextlib.contextmanager
+def _single_threaded_workers():
+    """The workers inherit the environment when they are spawned. Keep the native thread pools of every
+    worker single threaded while the pool starts them, otherwise each worker would start one thread per core.
+    The environment of the plugin process is restored afterwards.
+    """
+    names = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+    with _thread_env_lock:
+        saved = {name: os.environ.get(name) for name in names}
+        for name in names:
+            os.environ.setdefault(name, "1")
+        try:
+            yield
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+
+def _init_worker(caches, started):
+    # The default logging level in a new process is warning, route the plugin logs through absl once per worker.
+    import absl.logging
+    absl.logging.use_absl_handler()
+
+    global _caches, _started
+    _caches = caches
+    _started = started
+
+
+def _process_data(index, run_name, run_dir, worker, span, path):
+    _started.put((index, os.getpid()))
+    try:
+        logger.debug("Parse trace, run_dir=%s, worker=%s", run_dir, path)
+        local_file = _caches.get_remote_cache(io.join(run_dir, path))
+        data, trace_path = RunProfileData.parse(worker, span, local_file)
+        if trace_path != local_file:
+            _caches.add_file(local_file, trace_path)
+
+        generator = RunGenerator(worker, span, data)
+        profile = generator.generate_run_profile()
+        dist_data = DistributedRunProfileData(data)
+
+        logger.debug("Sending back profile via process pool")
+        return index, profile, dist_data
+    except Exception as ex:
+        logger.warning("Failed to parse profile data for Run %s on %s. Exception=%s",
+                       run_name, worker, ex, exc_info=True)
+        return index, None, None
+    finally:
+        logger.debug("finishing process data")
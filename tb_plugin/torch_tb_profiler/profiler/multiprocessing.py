@@ -5,5 +5,8 @@ import os
 def get_start_method():
     return os.getenv('TORCH_PROFILER_START_METHOD', "spawn")
 
-__all__ = [x for x in dir(mp.get_context(get_start_method())) if not x.startswith('_')]
-globals().update((name, getattr(mp.get_context(get_start_method()), name)) for name in __all__)
+# Resolve the context once and re-export its Process, Queue, Lock, etc. from this module.
+_context = mp.get_context(get_start_method())
+
+__all__ = [x for x in dir(_context) if not x.startswith('_')]
+globals().update((name, getattr(_context, name)) for name in __all__)
@@ -23,4 +23,4 @@ def get_logger():
     return logger
 
 def is_chrome_trace_file(path):
-    return consts.WORKER_PATTERN.match(path)
+    return path.endswith(consts.TRACE_FILE_SUFFIXES) and consts.WORKER_PATTERN.match(path)